@@ -6,7 +6,7 @@ import gradio as gr
 from dotenv import load_dotenv
 from distutils.util import strtobool
 
-from llama2_wrapper import LLAMA2_WRAPPER
+from llama2_wrapper import LLAMA2_WRAPPER, InputTooLongError
 
 load_dotenv()
 
@@ -42,13 +42,6 @@ LLAMA_CPP = bool(strtobool(os.getenv("LLAMA_CPP", "True")))
 
 if LLAMA_CPP:
     print("Running on CPU with llama.cpp.")
-else:
-    import torch
-
-    if torch.cuda.is_available():
-        print("Running on GPU with torch transformers.")
-    else:
-        print("CUDA not found.")
 
 config = {
     "model_name": MODEL_PATH,
@@ -104,9 +97,13 @@ def generate(
         raise ValueError
 
     history = history_with_input[:-1]
-    generator = llama2_wrapper.run(
-        message, history, system_prompt, max_new_tokens, temperature, top_p, top_k
-    )
+    try:
+        generator = llama2_wrapper.run(
+            message, history, system_prompt, max_new_tokens, temperature, top_p, top_k
+        )
+    except InputTooLongError as e:
+        # The pending turn stays in the chatbot so Undo restores the message.
+        raise gr.Error(str(e))
     try:
         first_response = next(generator)
         yield history + [(message, first_response)]
@@ -123,18 +120,6 @@ def process_example(message: str) -> tuple[str, list[tuple[str, str]]]:
     return "", x
 
 
-def check_input_token_length(
-    message: str, chat_history: list[tuple[str, str]], system_prompt: str
-) -> None:
-    input_token_length = llama2_wrapper.get_input_token_length(
-        message, chat_history, system_prompt
-    )
-    if input_token_length > MAX_INPUT_TOKEN_LENGTH:
-        raise gr.Error(
-            f"The accumulated input is too long ({input_token_length} > {MAX_INPUT_TOKEN_LENGTH}). Clear your chat history and try again."
-        )
-
-
 with gr.Blocks(css="style.css") as demo:
     gr.Markdown(DESCRIPTION)
 
@@ -215,11 +200,6 @@ with gr.Blocks(css="style.css") as demo:
         api_name=False,
         queue=False,
     ).then(
-        fn=check_input_token_length,
-        inputs=[saved_input, chatbot, system_prompt],
-        api_name=False,
-        queue=False,
-    ).success(
         fn=generate,
         inputs=[
             saved_input,
@@ -250,12 +230,6 @@ with gr.Blocks(css="style.css") as demo:
             queue=False,
         )
         .then(
-            fn=check_input_token_length,
-            inputs=[saved_input, chatbot, system_prompt],
-            api_name=False,
-            queue=False,
-        )
-        .success(
             fn=generate,
             inputs=[
                 saved_input,
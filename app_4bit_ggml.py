@@ -1,14 +1,22 @@
 import argparse
+import hashlib
 
 import os
+import sqlite3
+from contextlib import closing
 from typing import Iterator
 
+# Must run before llama_cpp is imported, OpenMP reads its thread count once.
+from llama2_wrapper._affinity import pin_to_performance_cores
+
+PERFORMANCE_CORES = pin_to_performance_cores()
+
 import gradio as gr
 
 # from dotenv import load_dotenv
 from distutils.util import strtobool
 
-from llama2_wrapper import LLAMA2_WRAPPER
+from llama2_wrapper import LLAMA2_WRAPPER, InputTooLongError
 
 
 parser = argparse.ArgumentParser()
@@ -24,6 +32,18 @@ parser.add_argument('--system_prompt', type=str, required=False, default=DEFAULT
 parser.add_argument('--max_max_new_tokens', type=int, default=2048, metavar='NUMBER',
                         help='maximum new tokens (default: 2048)')
 
+parser.add_argument('--server_mode', action='store_true',
+                    help='serve the model with a llama-server subprocess (continuous batching), requires a GGUF model.')
+
+parser.add_argument('--server_parallel', type=int, default=4, metavar='NUMBER',
+                        help='parallel llama-server slots in server mode (default: 4)')
+
+parser.add_argument('--server_port', type=int, default=8080, metavar='NUMBER',
+                        help='port of the llama-server subprocess in server mode (default: 8080)')
+
+parser.add_argument('--token_cache_path', type=str, default='',
+                    help='persist tokenizer output in this SQLite file (stores user messages on disk). Default is off.')
+
 FLAGS = parser.parse_args()
 
 
@@ -44,13 +64,6 @@ LLAMA_CPP = True
 
 if LLAMA_CPP:
     print("Running on CPU with llama.cpp.")
-else:
-    import torch
-
-    if torch.cuda.is_available():
-        print("Running on GPU with torch transformers.")
-    else:
-        print("CUDA not found.")
 
 config = {
     "model_name": MODEL_PATH,
@@ -58,7 +71,13 @@ config = {
     "load_in_4bit": LOAD_IN_4BIT,
     "llama_cpp": LLAMA_CPP,
     "MAX_INPUT_TOKEN_LENGTH": MAX_INPUT_TOKEN_LENGTH,
+    "token_cache_path": FLAGS.token_cache_path or None,
+    "server_mode": FLAGS.server_mode,
+    "server_parallel": FLAGS.server_parallel,
+    "server_port": FLAGS.server_port,
 }
+if PERFORMANCE_CORES is not None:
+    config["n_threads"] = PERFORMANCE_CORES
 llama2_wrapper = LLAMA2_WRAPPER(config)
 llama2_wrapper.init_tokenizer()
 llama2_wrapper.init_model()
@@ -105,35 +124,54 @@ def generate(
         raise ValueError
 
     history = history_with_input[:-1]
-    generator = llama2_wrapper.run(
-        message, history, system_prompt, max_new_tokens, temperature, top_p, top_k
-    )
     try:
-        first_response = next(generator)
-        yield history + [(message, first_response)]
-    except StopIteration:
-        yield history + [(message, "")]
+        generator = llama2_wrapper.run(
+            message, history, system_prompt, max_new_tokens, temperature, top_p, top_k
+        )
+    except InputTooLongError as e:
+        # The pending turn stays in the chatbot so Undo restores the message.
+        raise gr.Error(str(e))
+    # Update the last turn in place and skip unchanged responses, every
+    # yield re-serializes the whole chat.
+    chat = history + [(message, "")]
+    yield chat
     for response in generator:
-        yield history + [(message, response)]
+        if response == chat[-1][1]:
+            continue
+        chat[-1] = (message, response)
+        yield chat
+
+
+EXAMPLE_CACHE_PATH = "_example_cache.sqlite"
+
+with closing(sqlite3.connect(EXAMPLE_CACHE_PATH)) as conn, conn:
+    conn.execute(
+        "CREATE TABLE IF NOT EXISTS example_cache (key TEXT PRIMARY KEY, response TEXT)"
+    )
 
 
 def process_example(message: str) -> tuple[str, list[tuple[str, str]]]:
+    # Examples are generated on first click and then served from disk,
+    # instead of generating all of them at startup.
+    key = hashlib.blake2b(
+        f"{MODEL_PATH}|{message}|{DEFAULT_SYSTEM_PROMPT}|1024|1|0.95|50".encode()
+    ).hexdigest()
+    with closing(sqlite3.connect(EXAMPLE_CACHE_PATH)) as conn:
+        row = conn.execute(
+            "SELECT response FROM example_cache WHERE key = ?", (key,)
+        ).fetchone()
+    if row is not None:
+        return "", [(message, row[0])]
+
     generator = generate(message, [], DEFAULT_SYSTEM_PROMPT, 1024, 1, 0.95, 50)
     for x in generator:
         pass
-    return "", x
-
-
-def check_input_token_length(
-    message: str, chat_history: list[tuple[str, str]], system_prompt: str
-) -> None:
-    input_token_length = llama2_wrapper.get_input_token_length(
-        message, chat_history, system_prompt
-    )
-    if input_token_length > MAX_INPUT_TOKEN_LENGTH:
-        raise gr.Error(
-            f"The accumulated input is too long ({input_token_length} > {MAX_INPUT_TOKEN_LENGTH}). Clear your chat history and try again."
+    with closing(sqlite3.connect(EXAMPLE_CACHE_PATH)) as conn, conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO example_cache (key, response) VALUES (?, ?)",
+            (key, x[-1][1]),
         )
+    return "", x
 
 
 with gr.Blocks(css="style.css") as demo:
@@ -197,103 +235,64 @@ with gr.Blocks(css="style.css") as demo:
         inputs=textbox,
         outputs=[textbox, chatbot],
         fn=process_example,
-        cache_examples=True,
+        cache_examples=False,
+        run_on_click=True,
     )
 
-    textbox.submit(
-        fn=clear_and_save_textbox,
-        inputs=textbox,
-        outputs=[textbox, saved_input],
-        api_name=False,
-        queue=False,
-    ).then(
-        fn=display_input,
-        inputs=[saved_input, chatbot],
-        outputs=chatbot,
-        api_name=False,
-        queue=False,
-    ).then(
-        fn=check_input_token_length,
-        inputs=[saved_input, chatbot, system_prompt],
-        api_name=False,
-        queue=False,
-    ).success(
-        fn=generate,
-        inputs=[
-            saved_input,
-            chatbot,
-            system_prompt,
-            max_new_tokens,
-            temperature,
-            top_p,
-            top_k,
-        ],
-        outputs=chatbot,
-        api_name=False,
-    )
-
-    button_event_preprocess = (
-        submit_button.click(
-            fn=clear_and_save_textbox,
-            inputs=textbox,
-            outputs=[textbox, saved_input],
-            api_name=False,
-            queue=False,
-        )
-        .then(
+    generate_inputs = [
+        saved_input,
+        chatbot,
+        system_prompt,
+        max_new_tokens,
+        temperature,
+        top_p,
+        top_k,
+    ]
+
+    def wire(event):
+        """Chain display_input and generate after ``event``."""
+        # The input length is checked inside generate, see LLAMA2_WRAPPER.run.
+        return event.then(
             fn=display_input,
             inputs=[saved_input, chatbot],
             outputs=chatbot,
             api_name=False,
             queue=False,
+        ).then(
+            fn=generate,
+            inputs=generate_inputs,
+            outputs=chatbot,
+            api_name=False,
         )
-        .then(
-            fn=check_input_token_length,
-            inputs=[saved_input, chatbot, system_prompt],
+
+    wire(
+        textbox.submit(
+            fn=clear_and_save_textbox,
+            inputs=textbox,
+            outputs=[textbox, saved_input],
             api_name=False,
             queue=False,
         )
-        .success(
-            fn=generate,
-            inputs=[
-                saved_input,
-                chatbot,
-                system_prompt,
-                max_new_tokens,
-                temperature,
-                top_p,
-                top_k,
-            ],
-            outputs=chatbot,
+    )
+
+    wire(
+        submit_button.click(
+            fn=clear_and_save_textbox,
+            inputs=textbox,
+            outputs=[textbox, saved_input],
             api_name=False,
+            queue=False,
         )
     )
 
-    retry_button.click(
-        fn=delete_prev_fn,
-        inputs=chatbot,
-        outputs=[chatbot, saved_input],
-        api_name=False,
-        queue=False,
-    ).then(
-        fn=display_input,
-        inputs=[saved_input, chatbot],
-        outputs=chatbot,
-        api_name=False,
-        queue=False,
-    ).then(
-        fn=generate,
-        inputs=[
-            saved_input,
-            chatbot,
-            system_prompt,
-            max_new_tokens,
-            temperature,
-            top_p,
-            top_k,
-        ],
-        outputs=chatbot,
-        api_name=False,
+    wire(
+        retry_button.click(
+            fn=delete_prev_fn,
+            inputs=chatbot,
+            outputs=[chatbot, saved_input],
+            api_name=False,
+            queue=False,
+        )
     )
 
     undo_button.click(
@@ -317,4 +316,7 @@ with gr.Blocks(css="style.css") as demo:
         api_name=False,
     )
 
-demo.queue(max_size=20).launch(server_name="0.0.0.0", server_port=8090)
+# Gradio runs one event at a time by default, llama-server can batch up to
+# server_parallel requests so let that many run concurrently.
+concurrency_count = FLAGS.server_parallel if FLAGS.server_mode else 1
+demo.queue(concurrency_count=concurrency_count, max_size=20).launch(server_name="0.0.0.0", server_port=8090)
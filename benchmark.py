@@ -42,13 +42,6 @@ def main():
 
     if LLAMA_CPP:
         print("Running on CPU with llama.cpp.")
-    else:
-        import torch
-
-        if torch.cuda.is_available():
-            print("Running on GPU with torch transformers.")
-        else:
-            print("CUDA not found.")
 
     config = {
         "model_name": MODEL_PATH,
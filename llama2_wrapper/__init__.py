@@ -1 +1 @@
-from .model import LLAMA2_WRAPPER, get_prompt
+from .model import LLAMA2_WRAPPER, InputTooLongError, get_prompt
@@ -0,0 +1,85 @@
+# coding:utf-8
+import os
+import subprocess
+import sys
+from typing import Optional
+
+BLAS_THREAD_ENV_VARS = ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS")
+
+
+def _parse_cpu_list(cpu_list: str) -> set[int]:
+    # Kernel cpulist format, e.g. "0-11,16".
+    cpus = set()
+    for part in cpu_list.strip().split(","):
+        if not part:
+            continue
+        start, _, end = part.partition("-")
+        cpus.update(range(int(start), int(end or start) + 1))
+    return cpus
+
+
+def _linux_performance_cores() -> Optional[tuple[set[int], int]]:
+    # Only exposed on Intel hybrid CPUs (12th gen+).
+    try:
+        with open("/sys/devices/cpu_core/cpus") as f:
+            cpus = _parse_cpu_list(f.read())
+    except OSError:
+        return None
+    if not cpus:
+        return None
+    # Hyper-threads of the same core share a thread_siblings_list.
+    cores = set()
+    for cpu in cpus:
+        try:
+            with open(
+                f"/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list"
+            ) as f:
+                cores.add(f.read().strip())
+        except OSError:
+            cores.add(str(cpu))
+    return cpus, len(cores)
+
+
+def _macos_performance_cores() -> Optional[int]:
+    try:
+        output = subprocess.run(
+            ["sysctl", "-n", "hw.perflevel0.physicalcpu"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        return int(output.strip())
+    except (OSError, subprocess.CalledProcessError, ValueError):
+        return None
+
+
+def pin_to_performance_cores() -> Optional[int]:
+    """Pin the process to the performance cores of a hybrid CPU.
+
+    Also sets the OpenMP / BLAS thread counts to the number of physical
+    performance cores unless already set. Has to run before llama_cpp is
+    imported since OpenMP reads its environment on first use. macOS does not
+    support pinning, there only the thread counts are set.
+
+    Returns the number of physical performance cores, or None if the CPU is
+    not a recognised hybrid CPU.
+    """
+    n_cores = None
+    if sys.platform.startswith("linux"):
+        performance_cores = _linux_performance_cores()
+        if performance_cores is not None:
+            cpus, n_cores = performance_cores
+            # Stay within the CPUs we are allowed to run on (e.g. cgroups).
+            cpus &= os.sched_getaffinity(0)
+            if cpus:
+                os.sched_setaffinity(0, cpus)
+                n_cores = min(n_cores, len(cpus))
+            else:
+                n_cores = None
+    elif sys.platform == "darwin":
+        n_cores = _macos_performance_cores()
+
+    if n_cores:
+        for env_var in BLAS_THREAD_ENV_VARS:
+            os.environ.setdefault(env_var, str(n_cores))
+    return n_cores
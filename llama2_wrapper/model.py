@@ -1,13 +1,53 @@
 # coding:utf-8
-from threading import Thread
+import functools
+import os
+import struct
+import time
+import warnings
+from contextlib import nullcontext
+from threading import Event, Lock, Thread
 from typing import Any, Iterator
 
+# Streamed answers are yielded every STREAM_YIELD_TOKENS tokens or
+# STREAM_YIELD_INTERVAL seconds, whichever comes first, to keep gradio's
+# per-update serialization off the decode loop.
+STREAM_YIELD_TOKENS = 8
+STREAM_YIELD_INTERVAL = 0.04
+
+STOP_STRINGS = ["Human:", "</s>"]
+
+# llama_ftype values of the K-quants recommended for CPU inference, decoding
+# is memory-bandwidth bound so fewer bytes per weight means more tokens/sec.
+RECOMMENDED_FILE_TYPES = {
+    15: "Q4_K_M",
+    16: "Q5_K_S",
+    17: "Q5_K_M",
+}
+
+
+class InputTooLongError(ValueError):
+    """The prompt plus max_new_tokens does not fit MAX_INPUT_TOKEN_LENGTH."""
+
 
 class LLAMA2_WRAPPER:
     def __init__(self, config: dict = {}):
         self.config = config
         self.model = None
         self.tokenizer = None
+        # Per-turn token ids are memoized so the pre-generation length check
+        # only tokenizes the new message; guarded since gradio runs handlers
+        # concurrently.
+        self._tok_lock = Lock()
+        self._tok_turn = functools.lru_cache(maxsize=512)(self._tokenize_turn)
+        self._tok_system = functools.lru_cache(maxsize=8)(self._tokenize_system)
+        self._tok_message = functools.lru_cache(maxsize=8)(self._tokenize_message)
+        # An in-process model can only run one generation at a time, while
+        # llama-server batches concurrent requests itself.
+        if config.get("llama_cpp") and config.get("server_mode"):
+            self._gen_lock = nullcontext()
+        else:
+            self._gen_lock = Lock()
+        self._token_cache = None
 
     def init_model(self):
         if self.model is None:
@@ -16,6 +56,18 @@ class LLAMA2_WRAPPER:
             )
         if not self.config.get("llama_cpp"):
             self.model.eval()
+            # Resolve the streamer classes once instead of on every generate call.
+            from transformers import StoppingCriteriaList, TextIteratorStreamer
+
+            self._TextIteratorStreamer = TextIteratorStreamer
+            self._StoppingCriteriaList = StoppingCriteriaList
+        token_cache_path = self.config.get("token_cache_path")
+        if token_cache_path and self._token_cache is None:
+            from .tok_cache import TokenCache
+
+            self._token_cache = TokenCache(
+                token_cache_path, self.config.get("model_name", ""), self._tokenize_bytes
+            )
 
     def init_tokenizer(self):
         if self.tokenizer is None and not self.config.get("llama_cpp"):
@@ -27,37 +79,100 @@ class LLAMA2_WRAPPER:
         load_in_8bit = config.get("load_in_8bit", True)
         load_in_4bit = config.get("load_in_4bit", False)
         llama_cpp = config.get("llama_cpp", False)
-        if llama_cpp:
-            from llama_cpp import Llama
+        if llama_cpp and config.get("server_mode", False):
+            from .server import LlamaServer
 
+            model = LlamaServer(
+                model_path=model_name,
+                n_ctx=config.get("MAX_INPUT_TOKEN_LENGTH"),
+                n_threads=config.get(
+                    "n_threads", max(1, (os.cpu_count() or 2) // 2)
+                ),
+                n_batch=config.get("n_batch", 512),
+                parallel=config.get("server_parallel", 4),
+                port=config.get("server_port", 8080),
+                binary=config.get("server_binary", "llama-server"),
+            )
+        elif llama_cpp:
+            from llama_cpp import Llama, llama_print_system_info
+
+            # Half the logical CPUs approximates the physical core count.
+            n_threads = config.get("n_threads", max(1, (os.cpu_count() or 2) // 2))
             model = Llama(
                 model_path=model_name,
                 n_ctx=config.get("MAX_INPUT_TOKEN_LENGTH"),
-                n_batch=config.get("MAX_INPUT_TOKEN_LENGTH"),
+                n_batch=config.get("n_batch", 512),
+                n_threads=n_threads,
+                use_mmap=True,
+                use_mlock=True,
             )
-        elif load_in_4bit:
-            from auto_gptq import AutoGPTQForCausalLM
-
-            model = AutoGPTQForCausalLM.from_quantized(
-                model_name,
-                use_safetensors=True,
-                trust_remote_code=True,
-                device="cuda:0",
-                use_triton=False,
-                quantize_config=None,
+            LLAMA2_WRAPPER.check_llama_cpp_system_info(
+                llama_print_system_info().decode("utf-8")
             )
+            LLAMA2_WRAPPER.check_llama_cpp_file_type(model, model_name)
         else:
+            # Only initialise CUDA when a torch backend is actually selected.
             import torch
-            from transformers import AutoModelForCausalLM
 
-            model = AutoModelForCausalLM.from_pretrained(
-                model_name,
-                device_map="auto",
-                torch_dtype=torch.float16,
-                load_in_8bit=load_in_8bit,
-            )
+            if torch.cuda.is_available():
+                print("Running on GPU with torch transformers.")
+            else:
+                print("CUDA not found.")
+
+            if load_in_4bit:
+                from auto_gptq import AutoGPTQForCausalLM
+
+                model = AutoGPTQForCausalLM.from_quantized(
+                    model_name,
+                    use_safetensors=True,
+                    trust_remote_code=True,
+                    device="cuda:0",
+                    use_triton=False,
+                    quantize_config=None,
+                )
+            else:
+                from transformers import AutoModelForCausalLM
+
+                model = AutoModelForCausalLM.from_pretrained(
+                    model_name,
+                    device_map="auto",
+                    torch_dtype=torch.float16,
+                    load_in_8bit=load_in_8bit,
+                )
         return model
 
+    @classmethod
+    def check_llama_cpp_system_info(cls, system_info: str):
+        print(f"llama.cpp system info: {system_info}")
+        if "AVX2 = 1" not in system_info:
+            message = (
+                "llama.cpp was built without AVX2, generation on CPU will be slow. "
+                "See README to rebuild llama-cpp-python with AVX2/AVX512/OpenBLAS."
+            )
+            if os.getenv("LLAMA2_REQUIRE_AVX2") == "1":
+                raise RuntimeError(message)
+            warnings.warn(message)
+
+    @classmethod
+    def check_llama_cpp_file_type(cls, model, model_path: str):
+        # GGUF models expose their metadata, for GGML v3 (ggjt) files the
+        # ftype is the last int32 of the hparams header.
+        file_type = getattr(model, "metadata", {}).get("general.file_type")
+        if file_type is None:
+            with open(model_path, "rb") as f:
+                header = f.read(36)
+            if len(header) == 36 and header[:4] == b"tjgg":
+                file_type = struct.unpack("<7i", header[8:36])[6]
+        if file_type is None:
+            return
+        if int(file_type) not in RECOMMENDED_FILE_TYPES:
+            warnings.warn(
+                f"Model file type {file_type} is not a recommended K-quant "
+                f"({', '.join(RECOMMENDED_FILE_TYPES.values())}). CPU decoding is "
+                "memory-bandwidth bound, a Q4_K_M model is usually faster at "
+                "similar quality."
+            )
+
     @classmethod
     def create_llama2_tokenizer(cls, config):
         model_name = config.get("model_name")
@@ -70,19 +185,62 @@ class LLAMA2_WRAPPER:
         self,
         prompt: str,
     ) -> int:
+        # BOS + prompt
+        return 1 + len(self._tokenize(prompt))
+
+    def _tokenize_bytes(self, text: bytes) -> list[int]:
+        # Prompt fragments are tokenized without BOS, callers add it once.
         if self.config.get("llama_cpp"):
-            input_ids = self.model.tokenize(bytes(prompt, "utf-8"))
-            return len(input_ids)
+            return self.model.tokenize(text, add_bos=False)
         else:
-            input_ids = self.tokenizer([prompt], return_tensors="np")["input_ids"]
-            return input_ids.shape[-1]
+            return self.tokenizer(
+                text.decode("utf-8"), add_special_tokens=False
+            )["input_ids"]
+
+    def _tokenize(self, text: str) -> tuple[int, ...]:
+        if self._token_cache is not None:
+            return tuple(self._token_cache.get_or_tokenize(bytes(text, "utf-8")))
+        return tuple(self._tokenize_bytes(bytes(text, "utf-8")))
+
+    def _tokenize_turn(self, user_input: str, response: str) -> tuple[int, ...]:
+        return self._tokenize(format_turn(user_input, response))
+
+    def _tokenize_system(self, system_prompt: str) -> tuple[int, ...]:
+        return self._tokenize(format_system(system_prompt))
+
+    def _tokenize_message(self, message: str) -> tuple[int, ...]:
+        return self._tokenize(format_message(message))
 
     def get_input_token_length(
         self, message: str, chat_history: list[tuple[str, str]], system_prompt: str
     ) -> int:
-        prompt = get_prompt(message, chat_history, system_prompt)
+        with self._tok_lock:
+            # BOS + system prompt + history turns + new message
+            input_token_length = 1
+            if len(system_prompt) > 0:
+                input_token_length += len(self._tok_system(system_prompt))
+            for user_input, response in chat_history:
+                input_token_length += len(self._tok_turn(user_input, response))
+            input_token_length += len(self._tok_message(message))
+        return input_token_length
 
-        return self.get_token_length(prompt)
+    def truncate_chat_history(
+        self,
+        message: str,
+        chat_history: list[tuple[str, str]],
+        max_tokens: int,
+    ) -> list[tuple[str, str]]:
+        """Keep the most recent turns whose tokens fit ``max_tokens``."""
+        with self._tok_lock:
+            # BOS + new message always have to fit
+            max_tokens -= 1 + len(self._tok_message(message))
+            kept = 0
+            for user_input, response in reversed(chat_history):
+                max_tokens -= len(self._tok_turn(user_input, response))
+                if max_tokens < 0:
+                    break
+                kept += 1
+        return chat_history[len(chat_history) - kept :]
 
     def generate(
         self,
@@ -91,54 +249,71 @@ class LLAMA2_WRAPPER:
         temperature: float = 0.8,
         top_p: float = 0.95,
         top_k: int = 50,
+    ) -> Iterator[str]:
+        # The lock is held until the generator is exhausted or closed.
+        with self._gen_lock:
+            yield from self._generate(
+                prompt, max_new_tokens, temperature, top_p, top_k
+            )
+
+    def _generate(
+        self,
+        prompt: str,
+        max_new_tokens: int,
+        temperature: float,
+        top_p: float,
+        top_k: int,
     ) -> Iterator[str]:
         if self.config.get("llama_cpp"):
-            inputs = self.model.tokenize(bytes(prompt, "utf-8"))
-            generate_kwargs = dict(
+            # llama.cpp handles sampling, UTF-8 boundaries and stop strings
+            # natively, and reuses the KV cache for the prompt prefix shared
+            # with the previous call.
+            completion = self.model.create_completion(
+                prompt,
+                max_tokens=max_new_tokens,
+                temperature=temperature,
                 top_p=top_p,
                 top_k=top_k,
-                temp=temperature,
+                stop=STOP_STRINGS,
+                stream=True,
+                logprobs=None,
+                echo=False,
             )
-
-            generator = self.model.generate(inputs, **generate_kwargs)
-            outputs = []
-            answer_message =''
-            new_tokens = []
-            for token in generator:
-                if token!='</s>':
-                    try:
-                        new_tokens.append(token)
-                        b_text = self.model.detokenize(new_tokens)
-                        # b_text = self.model.decode(new_tokens)
-                        answer_message+=str(b_text, encoding="utf-8")
-                        new_tokens = []
-                    except:
-                        pass
-                else:
+            answer_message = ""
+            last_yield_ts = time.monotonic()
+            tokens_since_yield = 0
+            for chunk in completion:
+                tokens_since_yield += 1
+                text = chunk["choices"][0]["text"]
+                # Tokens held back mid-character or as a possible stop string
+                # prefix come through empty, there is nothing new to show.
+                if not text:
+                    continue
+                answer_message += text
+                if (
+                    tokens_since_yield >= STREAM_YIELD_TOKENS
+                    or time.monotonic() - last_yield_ts > STREAM_YIELD_INTERVAL
+                ):
                     yield answer_message
-                    break
+                    last_yield_ts = time.monotonic()
+                    tokens_since_yield = 0
 
-                if 'Human:' in answer_message:
-                    answer_message = answer_message.split('Human:')[0]
-                    yield answer_message
-                    break
-                
-                if token == self.model.token_eos():
-                    yield answer_message
-                    break
-                
-                yield answer_message
+            yield answer_message
         else:
-            from transformers import TextIteratorStreamer
-
             inputs = self.tokenizer([prompt], return_tensors="pt").to("cuda")
 
-            streamer = TextIteratorStreamer(
+            streamer = self._TextIteratorStreamer(
                 self.tokenizer, timeout=10.0, skip_prompt=True, skip_special_tokens=True
             )
+            # Lets a closed generator stop the background decode, so the
+            # generation lock is only released once the model is idle.
+            stop_event = Event()
             generate_kwargs = dict(
                 inputs,
                 streamer=streamer,
+                stopping_criteria=self._StoppingCriteriaList(
+                    [lambda input_ids, scores, **kwargs: stop_event.is_set()]
+                ),
                 max_new_tokens=max_new_tokens,
                 do_sample=True,
                 top_p=top_p,
@@ -149,10 +324,14 @@ class LLAMA2_WRAPPER:
             t = Thread(target=self.model.generate, kwargs=generate_kwargs)
             t.start()
 
-            outputs = []
-            for text in streamer:
-                outputs.append(text)
-                yield "".join(outputs)
+            try:
+                outputs = []
+                for text in streamer:
+                    outputs.append(text)
+                    yield "".join(outputs)
+            finally:
+                stop_event.set()
+                t.join()
 
     def run(
         self,
@@ -164,6 +343,24 @@ class LLAMA2_WRAPPER:
         top_p: float = 0.95,
         top_k: int = 50,
     ) -> Iterator[str]:
+        max_input_token_length = self.config.get("MAX_INPUT_TOKEN_LENGTH", 4000)
+        max_tokens = max_input_token_length - max_new_tokens
+        if len(system_prompt) > 0:
+            with self._tok_lock:
+                max_tokens -= len(self._tok_system(system_prompt))
+        chat_history = self.truncate_chat_history(message, chat_history, max_tokens)
+
+        # Everything is tokenized and cached by now, so this costs no extra pass.
+        input_token_length = self.get_input_token_length(
+            message, chat_history, system_prompt
+        )
+        if input_token_length + max_new_tokens > max_input_token_length:
+            raise InputTooLongError(
+                f"The input is too long ({input_token_length} + {max_new_tokens} "
+                f"new tokens > {max_input_token_length}). Shorten your message "
+                "or system prompt, or lower max new tokens, and try again."
+            )
+
         prompt = get_prompt(message, chat_history, system_prompt)
         return self.generate(prompt, max_new_tokens, temperature, top_p, top_k)
 
@@ -172,26 +369,38 @@ class LLAMA2_WRAPPER:
         prompt: str,
         **kwargs: Any,
     ) -> str:
-        if self.config.get("llama_cpp"):
-            return self.model.__call__(prompt, **kwargs)["choices"][0]["text"]
-        else:
-            inputs = self.tokenizer([prompt], return_tensors="pt").input_ids.to("cuda")
-            output = self.model.generate(inputs=inputs, **kwargs)
-            return self.tokenizer.decode(output[0])
+        with self._gen_lock:
+            if self.config.get("llama_cpp"):
+                return self.model.__call__(prompt, **kwargs)["choices"][0]["text"]
+            else:
+                inputs = self.tokenizer([prompt], return_tensors="pt").input_ids.to(
+                    "cuda"
+                )
+                output = self.model.generate(inputs=inputs, **kwargs)
+                return self.tokenizer.decode(output[0])
+
+
+def format_system(system_prompt: str) -> str:
+    return f"<s>System: {system_prompt.strip()}\n</s>"
+
+
+# Cached so each history turn is stripped and formatted once per lifetime.
+@functools.lru_cache(maxsize=512)
+def format_turn(user_input: str, response: str) -> str:
+    return f"<s>Human: {user_input.strip()}\n</s><s>Assistant: {response.strip()}\n</s>"
+
+
+def format_message(message: str) -> str:
+    return f"<s>Human: {message.strip()}\n</s><s>Assistant: "
 
 
 def get_prompt(
     message: str, chat_history: list[tuple[str, str]], system_prompt: str
 ) -> str:
-    prompt = ''
+    parts = []
+    if len(system_prompt) > 0:
+        parts.append(format_system(system_prompt))
     for user_input, response in chat_history:
-        prompt += "<s>Human: " + user_input.strip()+"\n</s><s>Assistant: " + response.strip()+"\n</s>"
-        
-    prompt += "<s>Human: " + message.strip() +"\n</s><s>Assistant: "
-    prompt = prompt[-2048:]
-    
-    if len(system_prompt)>0:
-        prompt = '<s>System: '+system_prompt.strip()+'\n</s>'+ prompt
-    return prompt
-
-
+        parts.append(format_turn(user_input, response))
+    parts.append(format_message(message))
+    return "".join(parts)
@@ -0,0 +1,149 @@
+# coding:utf-8
+import atexit
+import json
+import subprocess
+import time
+import urllib.error
+import urllib.request
+from typing import Any, Iterator, Optional
+
+
+class LlamaServer:
+    """Client for a llama.cpp ``llama-server`` subprocess.
+
+    Exposes the subset of ``llama_cpp.Llama`` used by ``LLAMA2_WRAPPER`` so the
+    server can stand in for the in-process model. The server batches decoding
+    of concurrent requests (continuous batching) and caches prompt prefixes.
+    """
+
+    def __init__(
+        self,
+        model_path: str,
+        n_ctx: int,
+        n_threads: int,
+        n_batch: int = 512,
+        parallel: int = 4,
+        host: str = "127.0.0.1",
+        port: int = 8080,
+        binary: str = "llama-server",
+        startup_timeout: float = 600.0,
+    ):
+        # Every llama.cpp build that ships llama-server only loads GGUF files.
+        with open(model_path, "rb") as f:
+            if f.read(4) != b"GGUF":
+                raise ValueError(
+                    f"llama-server requires a GGUF model, {model_path} is not a "
+                    "GGUF file (GGML .bin models only work without server mode)."
+                )
+        self.base_url = f"http://{host}:{port}"
+        # The server splits its context evenly between the parallel slots.
+        self.process = subprocess.Popen(
+            [
+                binary,
+                "-m",
+                model_path,
+                "-c",
+                str(n_ctx * parallel),
+                "-t",
+                str(n_threads),
+                "-b",
+                str(n_batch),
+                "--host",
+                host,
+                "--port",
+                str(port),
+                "--cont-batching",
+                "--parallel",
+                str(parallel),
+            ]
+        )
+        atexit.register(self.close)
+        self._wait_until_ready(startup_timeout)
+
+    def _wait_until_ready(self, timeout: float):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    f"llama-server exited with code {self.process.returncode}"
+                )
+            # Check the process again after a successful probe: if another
+            # service owns the port, our server fails to bind and exits.
+            if self._is_ready() and self.process.poll() is None:
+                return
+            time.sleep(0.5)
+        raise RuntimeError(f"llama-server did not start within {timeout} seconds")
+
+    def _is_ready(self) -> bool:
+        try:
+            with urllib.request.urlopen(self.base_url + "/health", timeout=1):
+                return True
+        except urllib.error.HTTPError as e:
+            # 503 while the model is loading, 404 on servers without /health.
+            if e.code != 404:
+                return False
+        except OSError:
+            return False
+        try:
+            self.tokenize(b"", add_bos=False, timeout=1)
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def close(self):
+        if self.process.poll() is None:
+            self.process.terminate()
+            self.process.wait()
+
+    def _post(self, endpoint: str, payload: dict, timeout: Optional[float] = None):
+        request = urllib.request.Request(
+            self.base_url + endpoint,
+            data=json.dumps(payload).encode("utf-8"),
+            headers={"Content-Type": "application/json"},
+        )
+        return urllib.request.urlopen(request, timeout=timeout)
+
+    def tokenize(
+        self, text: bytes, add_bos: bool = True, timeout: Optional[float] = None
+    ) -> list[int]:
+        payload = {"content": text.decode("utf-8"), "add_special": add_bos}
+        with self._post("/tokenize", payload, timeout) as response:
+            return json.load(response)["tokens"]
+
+    def create_completion(
+        self,
+        prompt: str,
+        max_tokens: int = 16,
+        temperature: float = 0.8,
+        top_p: float = 0.95,
+        top_k: int = 40,
+        stop: Optional[list[str]] = None,
+        stream: bool = False,
+        **kwargs: Any,
+    ) -> Iterator[dict]:
+        payload = {
+            "prompt": prompt,
+            "n_predict": max_tokens,
+            "temperature": temperature,
+            "top_p": top_p,
+            "top_k": top_k,
+            "stop": stop or [],
+            "stream": stream,
+            "cache_prompt": True,
+        }
+        with self._post("/completion", payload) as response:
+            if not stream:
+                result = json.load(response)
+                yield {"choices": [{"text": result["content"]}]}
+                return
+            # Server-sent events, one "data: {...}" line per token.
+            for line in response:
+                if not line.startswith(b"data: "):
+                    continue
+                event = json.loads(line[len(b"data: ") :])
+                yield {"choices": [{"text": event["content"]}]}
+                if event.get("stop"):
+                    break
+
+    def __call__(self, prompt: str, **kwargs: Any) -> dict:
+        return next(self.create_completion(prompt, stream=False, **kwargs))
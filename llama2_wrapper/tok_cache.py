@@ -0,0 +1,80 @@
+# coding:utf-8
+import hashlib
+import sqlite3
+import time
+from array import array
+from threading import Lock
+from typing import Callable
+
+
+class TokenCache:
+    """On-disk memoization of tokenizer output, persisted across restarts.
+
+    Entries are keyed by the sha256 of ``namespace`` (e.g. the model path,
+    since token ids are tokenizer specific) and the text. The least recently
+    used entries are evicted once the table holds more than ``max_entries``.
+    """
+
+    def __init__(
+        self,
+        path: str,
+        namespace: str,
+        tokenize: Callable[[bytes], list[int]],
+        max_entries: int = 100000,
+        clock: Callable[[], float] = time.time,
+    ):
+        self.namespace = namespace.encode("utf-8")
+        self.tokenize = tokenize
+        self.max_entries = max_entries
+        self.clock = clock
+        self._lock = Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS tok_cache ("
+                "text_sha256 TEXT PRIMARY KEY, token_count INT, "
+                "token_bytes BLOB, last_used REAL)"
+            )
+            self._conn.execute(
+                "CREATE INDEX IF NOT EXISTS tok_cache_last_used "
+                "ON tok_cache (last_used)"
+            )
+        # Tracked here so inserts do not need a COUNT(*) each time.
+        self._count = self._conn.execute(
+            "SELECT COUNT(*) FROM tok_cache"
+        ).fetchone()[0]
+
+    def get_or_tokenize(self, text: bytes) -> list[int]:
+        key = hashlib.sha256(self.namespace + b"\0" + text).hexdigest()
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT token_bytes FROM tok_cache WHERE text_sha256 = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                with self._conn:
+                    self._conn.execute(
+                        "UPDATE tok_cache SET last_used = ? WHERE text_sha256 = ?",
+                        (self.clock(), key),
+                    )
+                return array("i", row[0]).tolist()
+
+        tokens = list(self.tokenize(text))
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT OR IGNORE INTO tok_cache VALUES (?, ?, ?, ?)",
+                (key, len(tokens), array("i", tokens).tobytes(), self.clock()),
+            )
+            self._count += cursor.rowcount
+            if self._count > self.max_entries:
+                cursor = self._conn.execute(
+                    "DELETE FROM tok_cache WHERE text_sha256 IN ("
+                    "SELECT text_sha256 FROM tok_cache ORDER BY last_used LIMIT ?)",
+                    (self._count - self.max_entries,),
+                )
+                self._count -= cursor.rowcount
+        return tokens
+
+    def close(self):
+        self._conn.close()
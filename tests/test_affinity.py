@@ -0,0 +1,91 @@
+import pytest
+
+from llama2_wrapper import _affinity
+from llama2_wrapper._affinity import (
+    BLAS_THREAD_ENV_VARS,
+    _parse_cpu_list,
+    pin_to_performance_cores,
+)
+
+
+def test_parse_cpu_list():
+    assert _parse_cpu_list("0-3,8,10-11\n") == {0, 1, 2, 3, 8, 10, 11}
+    assert _parse_cpu_list("5") == {5}
+    assert _parse_cpu_list("\n") == set()
+
+
+def blas_env(environ) -> dict:
+    return {
+        env_var: environ[env_var]
+        for env_var in BLAS_THREAD_ENV_VARS
+        if env_var in environ
+    }
+
+
+@pytest.fixture
+def environ(monkeypatch):
+    environ = {"MKL_NUM_THREADS": "1"}
+    monkeypatch.setattr(_affinity.os, "environ", environ)
+    return environ
+
+
+@pytest.fixture
+def linux(monkeypatch):
+    """Hybrid CPU with P-cores 0-7 (4 physical cores), process on CPUs 0-5."""
+    pinned = []
+    monkeypatch.setattr(_affinity.sys, "platform", "linux")
+    monkeypatch.setattr(
+        _affinity, "_linux_performance_cores", lambda: (set(range(8)), 4)
+    )
+    monkeypatch.setattr(_affinity.os, "sched_getaffinity", lambda pid: set(range(6)))
+    monkeypatch.setattr(
+        _affinity.os, "sched_setaffinity", lambda pid, cpus: pinned.append(cpus)
+    )
+    return pinned
+
+
+def test_linux_pins_to_allowed_performance_cores(linux, environ):
+    assert pin_to_performance_cores() == 4
+    assert linux == [set(range(6))]
+    assert environ["OMP_NUM_THREADS"] == "4"
+    assert environ["OPENBLAS_NUM_THREADS"] == "4"
+    # Thread counts set by the user are kept.
+    assert environ["MKL_NUM_THREADS"] == "1"
+
+
+def test_linux_thread_count_capped_by_allowed_cpus(linux, environ, monkeypatch):
+    monkeypatch.setattr(_affinity.os, "sched_getaffinity", lambda pid: {6, 7, 8})
+    assert pin_to_performance_cores() == 2
+    assert linux == [{6, 7}]
+
+
+def test_linux_no_allowed_performance_cores(linux, environ, monkeypatch):
+    monkeypatch.setattr(_affinity.os, "sched_getaffinity", lambda pid: {8, 9})
+    assert pin_to_performance_cores() is None
+    assert linux == []
+    assert blas_env(environ) == {"MKL_NUM_THREADS": "1"}
+
+
+def test_linux_not_hybrid(linux, environ, monkeypatch):
+    monkeypatch.setattr(_affinity, "_linux_performance_cores", lambda: None)
+    assert pin_to_performance_cores() is None
+    assert linux == []
+    assert blas_env(environ) == {"MKL_NUM_THREADS": "1"}
+
+
+def test_macos_sets_thread_counts_only(environ, monkeypatch):
+    monkeypatch.setattr(_affinity.sys, "platform", "darwin")
+    monkeypatch.setattr(_affinity, "_macos_performance_cores", lambda: 8)
+    assert pin_to_performance_cores() == 8
+    assert blas_env(environ) == {
+        "OMP_NUM_THREADS": "8",
+        "OPENBLAS_NUM_THREADS": "8",
+        "MKL_NUM_THREADS": "1",
+    }
+
+
+def test_macos_without_performance_levels(environ, monkeypatch):
+    monkeypatch.setattr(_affinity.sys, "platform", "darwin")
+    monkeypatch.setattr(_affinity, "_macos_performance_cores", lambda: None)
+    assert pin_to_performance_cores() is None
+    assert blas_env(environ) == {"MKL_NUM_THREADS": "1"}
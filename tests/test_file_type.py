@@ -0,0 +1,37 @@
+import struct
+import warnings
+
+import pytest
+
+from llama2_wrapper import LLAMA2_WRAPPER
+
+LLAMA_FTYPE_Q4_0 = 2
+LLAMA_FTYPE_Q4_K_M = 15
+
+
+def write_ggjt_model(path, file_type: int) -> str:
+    # magic, version, then n_vocab, n_embd, n_mult, n_head, n_layer, n_rot, ftype
+    hparams = struct.pack("<7i", 32000, 4096, 256, 32, 32, 128, file_type)
+    path.write_bytes(b"tjgg" + struct.pack("<I", 3) + hparams)
+    return str(path)
+
+
+def test_warns_for_non_k_quant_ggml(tmp_path):
+    model_path = write_ggjt_model(tmp_path / "model.bin", LLAMA_FTYPE_Q4_0)
+    with pytest.warns(UserWarning, match="Q4_K_M"):
+        LLAMA2_WRAPPER.check_llama_cpp_file_type(object(), model_path)
+
+
+def test_accepts_k_quant_ggml(tmp_path):
+    model_path = write_ggjt_model(tmp_path / "model.bin", LLAMA_FTYPE_Q4_K_M)
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        LLAMA2_WRAPPER.check_llama_cpp_file_type(object(), model_path)
+
+
+def test_prefers_gguf_metadata():
+    class GGUFModel:
+        metadata = {"general.file_type": str(LLAMA_FTYPE_Q4_0)}
+
+    with pytest.warns(UserWarning):
+        LLAMA2_WRAPPER.check_llama_cpp_file_type(GGUFModel(), "/nonexistent.gguf")
@@ -0,0 +1,158 @@
+import contextlib
+import queue
+import threading
+
+import pytest
+
+from llama2_wrapper import LLAMA2_WRAPPER, InputTooLongError, get_prompt
+
+
+class FakeLlama:
+    """Byte-level tokenizer standing in for llama_cpp.Llama."""
+
+    def __init__(self, answer: str = "Hello!"):
+        self.answer = answer
+        self.prompts = []
+
+    def tokenize(self, text: bytes, add_bos: bool = True) -> list[int]:
+        return ([1] if add_bos else []) + list(text)
+
+    def create_completion(self, prompt: str, **kwargs):
+        self.prompts.append(prompt)
+        for char in self.answer:
+            yield {"choices": [{"text": char}]}
+
+
+def make_wrapper(max_input_token_length: int = 4000) -> LLAMA2_WRAPPER:
+    llama2_wrapper = LLAMA2_WRAPPER(
+        {"llama_cpp": True, "MAX_INPUT_TOKEN_LENGTH": max_input_token_length}
+    )
+    llama2_wrapper.model = FakeLlama()
+    return llama2_wrapper
+
+
+def test_input_token_length_matches_full_prompt():
+    llama2_wrapper = make_wrapper()
+    chat_history = [("你好", "Hi there"), ("How are you?", "Fine.")]
+    prompt = get_prompt("Bye", chat_history, "Be nice.")
+    assert llama2_wrapper.get_input_token_length(
+        "Bye", chat_history, "Be nice."
+    ) == llama2_wrapper.get_token_length(prompt)
+
+
+def test_run_streams_answer():
+    llama2_wrapper = make_wrapper()
+    *_, answer = llama2_wrapper.run("Hi", [], "", max_new_tokens=16)
+    assert answer == "Hello!"
+    assert llama2_wrapper.model.prompts == [get_prompt("Hi", [], "")]
+
+
+def test_run_raises_when_input_too_long():
+    llama2_wrapper = make_wrapper(max_input_token_length=64)
+    with pytest.raises(InputTooLongError):
+        llama2_wrapper.run("x" * 64, [], "", max_new_tokens=16)
+    # The budget includes max_new_tokens.
+    with pytest.raises(InputTooLongError):
+        llama2_wrapper.run("x", [], "", max_new_tokens=64)
+    assert llama2_wrapper.model.prompts == []
+
+
+def test_generate_releases_lock_on_close():
+    llama2_wrapper = make_wrapper()
+    generator = llama2_wrapper.generate("Hi")
+    next(generator)
+    assert llama2_wrapper._gen_lock.locked()
+    generator.close()
+    assert not llama2_wrapper._gen_lock.locked()
+
+
+class FakeTransformersModel:
+    """Decodes until a stopping criterion fires, like model.generate."""
+
+    def __init__(self):
+        self.decoded_tokens = 0
+
+    def generate(self, streamer, stopping_criteria, **kwargs):
+        while not stopping_criteria(None, None) and self.decoded_tokens < 10000:
+            self.decoded_tokens += 1
+            streamer.put("token ")
+        streamer.end()
+
+
+class FakeStreamer:
+    def __init__(self, tokenizer, **kwargs):
+        self.queue = queue.Queue()
+
+    def put(self, text):
+        self.queue.put(text)
+
+    def end(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        while (text := self.queue.get()) is not None:
+            yield text
+
+
+class FakeInputs(dict):
+    def to(self, device):
+        return self
+
+
+def test_closing_transformers_generate_stops_decode_thread():
+    llama2_wrapper = LLAMA2_WRAPPER({"llama_cpp": False})
+    llama2_wrapper.model = FakeTransformersModel()
+    llama2_wrapper.tokenizer = lambda prompts, **kwargs: FakeInputs()
+    llama2_wrapper._TextIteratorStreamer = FakeStreamer
+    llama2_wrapper._StoppingCriteriaList = lambda criteria: (
+        lambda input_ids, scores: any(c(input_ids, scores) for c in criteria)
+    )
+    threads_before = set(threading.enumerate())
+    generator = llama2_wrapper.generate("Hi")
+    next(generator)
+    generator.close()
+    assert not llama2_wrapper._gen_lock.locked()
+    assert set(threading.enumerate()) <= threads_before
+    assert llama2_wrapper.model.decoded_tokens < 10000
+
+
+def test_truncate_chat_history_keeps_newest_turns_that_fit():
+    llama2_wrapper = make_wrapper()
+    chat_history = [("first", "a" * 100), ("second", "b"), ("third", "c")]
+    turn_lengths = [
+        len(llama2_wrapper._tok_turn(user_input, response))
+        for user_input, response in chat_history
+    ]
+    # BOS + new message
+    message_length = 1 + len(llama2_wrapper._tok_message("Hi"))
+
+    max_tokens = message_length + turn_lengths[1] + turn_lengths[2]
+    assert llama2_wrapper.truncate_chat_history(
+        "Hi", chat_history, max_tokens
+    ) == chat_history[1:]
+    assert llama2_wrapper.truncate_chat_history(
+        "Hi", chat_history, max_tokens - 1
+    ) == chat_history[2:]
+    assert llama2_wrapper.truncate_chat_history(
+        "Hi", chat_history, max_tokens + turn_lengths[0]
+    ) == chat_history
+    assert llama2_wrapper.truncate_chat_history("Hi", chat_history, 0) == []
+
+
+def test_run_drops_oldest_turns_to_leave_room_for_new_tokens():
+    llama2_wrapper = make_wrapper(max_input_token_length=200)
+    chat_history = [("old", "x" * 100), ("new", "y")]
+    list(llama2_wrapper.run("Hi", chat_history, "", max_new_tokens=100))
+    assert llama2_wrapper.model.prompts == [get_prompt("Hi", chat_history[1:], "")]
+
+
+def test_generation_lock_only_skipped_for_llama_server():
+    assert isinstance(
+        LLAMA2_WRAPPER({"llama_cpp": True, "server_mode": True})._gen_lock,
+        contextlib.nullcontext,
+    )
+    # server_mode is ignored for the transformers backend.
+    assert not isinstance(
+        LLAMA2_WRAPPER({"llama_cpp": False, "server_mode": True})._gen_lock,
+        contextlib.nullcontext,
+    )
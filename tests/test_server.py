@@ -0,0 +1,126 @@
+import json
+import socket
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+import pytest
+
+from llama2_wrapper.server import LlamaServer
+
+
+class FakeLlamaServerHandler(BaseHTTPRequestHandler):
+    requests = []
+    health_status = 200
+
+    def do_GET(self):
+        self.send_response(self.health_status)
+        self.end_headers()
+        self.wfile.write(b"{}")
+
+    def do_POST(self):
+        payload = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.requests.append((self.path, payload))
+        self.send_response(200)
+        self.end_headers()
+        if self.path == "/tokenize":
+            tokens = list(payload["content"].encode("utf-8"))
+            if payload["add_special"]:
+                tokens = [0] + tokens
+            self.wfile.write(json.dumps({"tokens": tokens}).encode("utf-8"))
+        elif payload["stream"]:
+            for content in ["你好", " world", ""]:
+                event = {"content": content, "stop": content == ""}
+                self.wfile.write(b"data: " + json.dumps(event).encode("utf-8"))
+                self.wfile.write(b"\n\n")
+        else:
+            self.wfile.write(json.dumps({"content": "你好 world"}).encode("utf-8"))
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def llama_server():
+    httpd = HTTPServer(("127.0.0.1", 0), FakeLlamaServerHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    # Skip __init__, which would start a real llama-server subprocess.
+    server = LlamaServer.__new__(LlamaServer)
+    server.base_url = f"http://127.0.0.1:{httpd.server_address[1]}"
+    FakeLlamaServerHandler.requests = []
+    FakeLlamaServerHandler.health_status = 200
+    yield server
+    httpd.shutdown()
+
+
+def test_rejects_non_gguf_model(tmp_path):
+    model_path = tmp_path / "llama-2-7b-chat.ggmlv3.q4_0.bin"
+    model_path.write_bytes(b"tjgg" + bytes(32))
+    with pytest.raises(ValueError, match="GGUF"):
+        LlamaServer(str(model_path), n_ctx=512, n_threads=1)
+
+
+def test_tokenize_asks_server_for_bos(llama_server):
+    assert llama_server.tokenize(b"ab", add_bos=False) == [97, 98]
+    assert llama_server.tokenize(b"ab") == [0, 97, 98]
+    assert FakeLlamaServerHandler.requests[-1] == (
+        "/tokenize",
+        {"content": "ab", "add_special": True},
+    )
+
+
+def test_create_completion_streams_sse_events(llama_server):
+    chunks = list(
+        llama_server.create_completion("hi", max_tokens=8, stop=["Human:"], stream=True)
+    )
+    assert [chunk["choices"][0]["text"] for chunk in chunks] == ["你好", " world", ""]
+    _, payload = FakeLlamaServerHandler.requests[-1]
+    assert payload["n_predict"] == 8
+    assert payload["stop"] == ["Human:"]
+
+
+def test_call_returns_full_completion(llama_server):
+    assert llama_server("hi")["choices"][0]["text"] == "你好 world"
+
+
+class FakeProcess:
+    def __init__(self, returncodes):
+        self.returncodes = iter(returncodes)
+        self.returncode = None
+
+    def poll(self):
+        self.returncode = next(self.returncodes, self.returncode)
+        return self.returncode
+
+
+def test_ready_once_health_returns_200(llama_server):
+    llama_server.process = FakeProcess([None, None])
+    llama_server._wait_until_ready(timeout=5)
+
+
+def test_ready_via_tokenize_without_health_endpoint(llama_server):
+    FakeLlamaServerHandler.health_status = 404
+    assert llama_server._is_ready()
+    assert FakeLlamaServerHandler.requests[-1][0] == "/tokenize"
+
+
+def test_not_ready_while_loading(llama_server):
+    FakeLlamaServerHandler.health_status = 503
+    llama_server.process = FakeProcess([None])
+    with pytest.raises(RuntimeError, match="did not start"):
+        llama_server._wait_until_ready(timeout=0.1)
+
+
+def test_fails_when_process_exits_after_probe(llama_server):
+    # Another service answered on the port, but our server failed to bind.
+    llama_server.process = FakeProcess([None, 1])
+    with pytest.raises(RuntimeError, match="exited with code 1"):
+        llama_server._wait_until_ready(timeout=5)
+
+
+def test_not_ready_when_nothing_listens():
+    server = LlamaServer.__new__(LlamaServer)
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        server.base_url = f"http://127.0.0.1:{sock.getsockname()[1]}"
+    assert not server._is_ready()
@@ -0,0 +1,27 @@
+import warnings
+
+import pytest
+
+from llama2_wrapper import LLAMA2_WRAPPER
+
+AVX2_SYSTEM_INFO = "AVX = 1 | AVX2 = 1 | AVX512 = 0 | FMA = 1 | F16C = 1 | BLAS = 0 | "
+NO_AVX2_SYSTEM_INFO = "AVX = 1 | AVX2 = 0 | AVX512 = 0 | FMA = 0 | F16C = 1 | BLAS = 0 | "
+
+
+def test_accepts_avx2_build(monkeypatch):
+    monkeypatch.setenv("LLAMA2_REQUIRE_AVX2", "1")
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        LLAMA2_WRAPPER.check_llama_cpp_system_info(AVX2_SYSTEM_INFO)
+
+
+def test_warns_without_avx2(monkeypatch):
+    monkeypatch.delenv("LLAMA2_REQUIRE_AVX2", raising=False)
+    with pytest.warns(UserWarning, match="AVX2"):
+        LLAMA2_WRAPPER.check_llama_cpp_system_info(NO_AVX2_SYSTEM_INFO)
+
+
+def test_require_avx2_raises_without_avx2(monkeypatch):
+    monkeypatch.setenv("LLAMA2_REQUIRE_AVX2", "1")
+    with pytest.raises(RuntimeError, match="AVX2"):
+        LLAMA2_WRAPPER.check_llama_cpp_system_info(NO_AVX2_SYSTEM_INFO)
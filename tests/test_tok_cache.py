@@ -0,0 +1,58 @@
+import itertools
+
+from llama2_wrapper.tok_cache import TokenCache
+
+
+class CountingTokenizer:
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, text: bytes) -> list[int]:
+        self.calls.append(text)
+        return list(text)
+
+
+def test_hits_skip_tokenizer_and_survive_restart(tmp_path):
+    path = str(tmp_path / "tok_cache.sqlite")
+    tokenize = CountingTokenizer()
+    cache = TokenCache(path, "model", tokenize)
+    assert cache.get_or_tokenize("你好".encode("utf-8")) == list("你好".encode("utf-8"))
+    assert cache.get_or_tokenize("你好".encode("utf-8")) == list("你好".encode("utf-8"))
+    cache.close()
+
+    cache = TokenCache(path, "model", tokenize)
+    assert cache.get_or_tokenize("你好".encode("utf-8")) == list("你好".encode("utf-8"))
+    assert len(tokenize.calls) == 1
+
+
+def test_entries_are_per_namespace(tmp_path):
+    path = str(tmp_path / "tok_cache.sqlite")
+    tokenize = CountingTokenizer()
+    TokenCache(path, "model-a", tokenize).get_or_tokenize(b"abc")
+    TokenCache(path, "model-b", tokenize).get_or_tokenize(b"abc")
+    assert len(tokenize.calls) == 2
+
+
+def test_evicts_least_recently_used(tmp_path):
+    # Strictly increasing timestamps, independent of the clock resolution.
+    clock = itertools.count()
+    tokenize = CountingTokenizer()
+    cache = TokenCache(
+        str(tmp_path / "tok_cache.sqlite"),
+        "model",
+        tokenize,
+        max_entries=2,
+        clock=lambda: next(clock),
+    )
+    cache.get_or_tokenize(b"a")
+    cache.get_or_tokenize(b"b")
+    cache.get_or_tokenize(b"a")  # b is now the least recently used
+    cache.get_or_tokenize(b"c")
+    assert cache._count == 2
+
+    tokenize.calls.clear()
+    cache.get_or_tokenize(b"a")
+    cache.get_or_tokenize(b"c")
+    assert tokenize.calls == []
+    cache.get_or_tokenize(b"b")
+    assert tokenize.calls == [b"b"]